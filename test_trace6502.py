@@ -0,0 +1,227 @@
+import json
+import os
+import struct
+
+import pytest
+
+from trace6502 import (
+    HEADER,
+    RECORD,
+    Trace,
+    TraceError,
+    TraceRecord,
+    TraceWriter,
+    compare,
+    first_difference,
+    load_opcodes,
+    main,
+)
+
+TABLE = os.path.join(os.path.dirname(__file__), "out", "6502.json")
+
+# LDA abs,X: 4 cycles, +1 on page cross.
+LDA_ABS_X = 0xBD
+
+
+def records(count, start_cycles=0):
+    cycles = start_cycles
+    for i in range(count):
+        cycles += 4
+        yield TraceRecord(i & 0xFFFF, LDA_ABS_X, i & 0xFF, 2, 3, 0xFD, 0x24, cycles)
+
+
+def write(path, recs, start_cycles=0):
+    with TraceWriter(str(path), start_cycles) as writer:
+        for record in recs:
+            writer.write(record)
+    return str(path)
+
+
+def mutate(recs, index, **fields):
+    for i, record in enumerate(recs):
+        if i == index:
+            for name, value in fields.items():
+                setattr(record, name, value)
+        yield record
+
+
+@pytest.fixture
+def opcodes():
+    return load_opcodes(TABLE)
+
+
+def test_round_trip(tmp_path):
+    recs = list(records(100, 7))
+    with Trace(write(tmp_path / "t.bin", recs, 7)) as trace:
+        assert len(trace) == 100
+        assert trace.start_cycles == 7
+        assert list(trace) == recs
+        assert trace[-1] == recs[-1]
+
+
+@pytest.mark.parametrize("start_cycles", [-1, 1 << 64])
+def test_writer_rejects_bad_start_cycles(tmp_path, start_cycles):
+    path = tmp_path / "t.bin"
+    with pytest.raises(struct.error):
+        TraceWriter(str(path), start_cycles)
+    assert not path.exists()
+
+
+def test_empty_trace(tmp_path):
+    path = write(tmp_path / "e.bin", [])
+    with Trace(path) as a, Trace(path) as b:
+        assert len(a) == 0
+        assert compare(a, b) is None
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        (b"6502", "truncated header"),
+        (b"x" * HEADER.size, "not a 6502 trace file"),
+        (HEADER.pack(b"6502TRC", 1, RECORD.size, 0), "unsupported trace version"),
+        (HEADER.pack(b"6502TRC", 2, RECORD.size, 0) + b"\0" * 5, "truncated record"),
+    ],
+)
+def test_invalid_header(tmp_path, data, message):
+    path = tmp_path / "bad.bin"
+    path.write_bytes(data)
+    with pytest.raises(TraceError, match=message):
+        Trace(str(path))
+
+
+def test_first_difference():
+    a = b"".join(r.pack() for r in records(10))
+    assert first_difference(a, a) == -1
+    for index in range(10):
+        b = bytearray(a)
+        b[index * RECORD.size + RECORD.size - 1] ^= 1
+        assert first_difference(a, bytes(b)) == index
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 65536, 10**6])
+@pytest.mark.parametrize("index", [0, 65535, 65536, 70000 - 1])
+def test_divergence_at_chunk_edges(tmp_path, chunk, index):
+    count = 70000
+    expected = write(tmp_path / "a.bin", records(count))
+    actual = write(tmp_path / "b.bin", mutate(records(count), index, cycles=0))
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b, chunk)
+    assert divergence.index == index
+    assert divergence.fields == ["cycles"]
+
+
+def test_unequal_length(tmp_path):
+    expected = write(tmp_path / "a.bin", records(10))
+    actual = write(tmp_path / "b.bin", records(7))
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+        assert divergence.index == 7
+        assert divergence.actual is None
+        divergence = compare(b, a)
+        assert divergence.index == 7
+        assert divergence.expected is None
+
+
+def test_cycle_divergence_blames_record(tmp_path, opcodes):
+    expected = write(tmp_path / "a.bin", records(10))
+    actual = write(tmp_path / "b.bin", mutate(records(10), 4, cycles=4 * 5 + 1))
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+    assert divergence.culprit == 4
+    assert (divergence.expected_cycles, divergence.actual_cycles) == (4, 5)
+    report = divergence.describe(opcodes)
+    assert "caused by record 4" in report
+    assert "LDA ABSOLUTE_X" in report
+    assert "table cycles: 4 (+1 on page cross)" in report
+
+
+def test_register_divergence_blames_previous_record(tmp_path, opcodes):
+    recs = list(mutate(records(10), 3, opcode=0xE8))  # INX
+    expected = write(tmp_path / "a.bin", recs)
+    actual = write(tmp_path / "b.bin", mutate(iter(recs), 4, x=0x7F))
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+    assert divergence.index == 4
+    assert divergence.fields == ["x"]
+    assert divergence.culprit == 3
+    assert divergence.expected_culprit.opcode == 0xE8
+    report = divergence.describe(opcodes)
+    assert "caused by record 3" in report
+    assert "INX IMPLIED" in report
+    assert "LDA" not in report
+
+
+def test_register_and_cycle_divergence_reports_both(tmp_path, opcodes):
+    recs = list(mutate(records(10), 3, opcode=0xE8))  # INX
+    expected = write(tmp_path / "a.bin", recs)
+    actual = write(tmp_path / "b.bin", mutate(iter(recs), 4, x=0x7F, cycles=21))
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+    assert divergence.fields == ["x", "cycles"]
+    assert divergence.culprit == 3
+    assert (divergence.expected_cycles, divergence.actual_cycles) == (4, 4)
+    assert (
+        divergence.expected_record_cycles,
+        divergence.actual_record_cycles,
+    ) == (4, 5)
+    report = divergence.describe(opcodes)
+    assert "INX IMPLIED" in report
+    assert "record 4 instruction: $0004 LDA ABSOLUTE_X" in report
+    assert "record 4 cycles taken: expected 4, actual 5" in report
+
+
+def test_register_divergence_at_first_record(tmp_path, opcodes):
+    expected = write(tmp_path / "a.bin", records(3))
+    actual = write(tmp_path / "b.bin", mutate(records(3), 0, a=0x55))
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+    assert divergence.culprit == -1
+    assert "state differs before the first instruction" in divergence.describe(
+        opcodes
+    )
+
+
+def test_opcode_divergence_decodes_both(tmp_path, opcodes):
+    expected = write(tmp_path / "a.bin", mutate(records(10), 5, opcode=0x69))
+    actual = write(tmp_path / "b.bin", mutate(records(10), 5, opcode=0x02))
+    with Trace(expected) as a, Trace(actual) as b:
+        report = compare(a, b).describe(opcodes)
+    assert "expected instruction: $0005 ADC IMMEDIATE" in report
+    assert "expected instruction table cycles: 2" in report
+    assert "actual instruction: $0005 $02 (not in opcode table)" in report
+
+
+def test_start_cycles(tmp_path):
+    expected = write(tmp_path / "a.bin", records(3, 7), 7)
+    actual = write(tmp_path / "b.bin", mutate(records(3, 7), 0, cycles=13), 7)
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+    assert (divergence.expected_cycles, divergence.actual_cycles) == (4, 6)
+
+
+def test_start_cycles_only_differ(tmp_path, opcodes):
+    expected = write(tmp_path / "a.bin", records(3, 7), 7)
+    actual = write(tmp_path / "b.bin", records(3, 7), 0)
+    with Trace(expected) as a, Trace(actual) as b:
+        divergence = compare(a, b)
+    assert divergence.index == 0
+    assert divergence.fields == ["start_cycles"]
+    assert (divergence.expected_cycles, divergence.actual_cycles) == (4, 11)
+    assert "start cycles: expected 7, actual 0" in divergence.describe(opcodes)
+
+
+def test_main_exit_codes(tmp_path, capsys):
+    expected = write(tmp_path / "a.bin", records(10))
+    actual = write(tmp_path / "b.bin", mutate(records(10), 2, cycles=0))
+    assert main([expected, expected, "--table", TABLE]) == 0
+    assert main([expected, actual, "--table", TABLE]) == 1
+    assert main([expected, str(tmp_path / "missing.bin"), "--table", TABLE]) == 2
+    (tmp_path / "table.json").write_text(json.dumps([{"name": "ADC"}]))
+    assert main([expected, actual, "--table", str(tmp_path / "table.json")]) == 2
+    assert main([expected, actual, "--table", str(tmp_path / "none.json")]) == 2
+    (tmp_path / "table.json").write_text(
+        json.dumps([{"name": "LDA", "operands": [{"opcode": LDA_ABS_X}]}])
+    )
+    assert main([expected, actual, "--table", str(tmp_path / "table.json")]) == 2
+    assert "Traceback" not in capsys.readouterr().err
@@ -0,0 +1,379 @@
+import argparse
+import json
+import mmap
+import struct
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# File header: magic, format version, record size and the cycle count
+# before the first record (traces taken after reset rarely start at 0),
+# padded to a whole number of records.
+MAGIC = b"6502TRC"
+VERSION = 2
+HEADER = struct.Struct("<7sBH6xQ8x")
+
+# One record per executed instruction. pc is the address the opcode was
+# fetched from, registers are sampled before execution and cycles is the
+# cumulative cycle count after the instruction has finished.
+RECORD = struct.Struct("<HBBBBBBQ")
+RECORD_FIELDS = ("pc", "opcode", "a", "x", "y", "sp", "p", "cycles")
+
+# Records compared per chunk when streaming two traces.
+DEFAULT_CHUNK = 1 << 16
+
+
+class TraceError(Exception):
+    pass
+
+
+class TraceRecord:
+    def __init__(
+        self,
+        pc: int,
+        opcode: int,
+        a: int,
+        x: int,
+        y: int,
+        sp: int,
+        p: int,
+        cycles: int,
+    ):
+        self.pc = pc
+        self.opcode = opcode
+        self.a = a
+        self.x = x
+        self.y = y
+        self.sp = sp
+        self.p = p
+        self.cycles = cycles
+
+    def pack(self) -> bytes:
+        return RECORD.pack(*(getattr(self, name) for name in RECORD_FIELDS))
+
+    @classmethod
+    def unpack(cls, buf, offset: int = 0) -> "TraceRecord":
+        return cls(*RECORD.unpack_from(buf, offset))
+
+    def __eq__(self, other):
+        if not isinstance(other, TraceRecord):
+            return NotImplemented
+        return self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        return (
+            f"TraceRecord(pc=${self.pc:04X}, opcode=${self.opcode:02X}, "
+            f"a=${self.a:02X}, x=${self.x:02X}, y=${self.y:02X}, "
+            f"sp=${self.sp:02X}, p=${self.p:02X}, cycles={self.cycles})"
+        )
+
+
+class TraceWriter:
+    def __init__(self, path: str, start_cycles: int = 0):
+        # Pack first so an out of range start count leaves no open file.
+        header = HEADER.pack(MAGIC, VERSION, RECORD.size, start_cycles)
+        self.file = open(path, "wb")
+        self.file.write(header)
+
+    def write(self, record: TraceRecord):
+        self.file.write(record.pack())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Trace:
+    """Read-only, memory mapped view of a trace file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            header = self.file.read(HEADER.size)
+            if len(header) != HEADER.size:
+                raise TraceError(f"{path}: truncated header")
+            magic, version, record_size, self.start_cycles = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise TraceError(f"{path}: not a 6502 trace file")
+            if version != VERSION or record_size != RECORD.size:
+                raise TraceError(
+                    f"{path}: unsupported trace version {version} "
+                    f"(record size {record_size})"
+                )
+            self.file.seek(0, 2)
+            body = self.file.tell() - HEADER.size
+            if body % RECORD.size:
+                raise TraceError(f"{path}: truncated record at end of file")
+            self.count = body // RECORD.size
+            # mmap refuses zero length mappings, empty traces need no map.
+            self.map = (
+                mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.count
+                else None
+            )
+        except Exception:
+            self.file.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int) -> TraceRecord:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return TraceRecord.unpack(self.map, HEADER.size + index * RECORD.size)
+
+    def __iter__(self) -> Iterator[TraceRecord]:
+        for index in range(self.count):
+            yield self[index]
+
+    def chunk(self, start: int, count: int) -> bytes:
+        if self.map is None:
+            return b""
+        begin = HEADER.size + start * RECORD.size
+        end = HEADER.size + min(start + count, self.count) * RECORD.size
+        return self.map[begin:end]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def first_difference(a: bytes, b: bytes) -> int:
+    """Index of the first differing record of two equal length chunks, or -1."""
+    if a == b:
+        return -1
+    # Bisect over 8 byte words so each step compares slices of the existing
+    # buffers in C without copying them, and a record is two words.
+    words = RECORD.size // 8
+    a, b = memoryview(a).cast("Q"), memoryview(b).cast("Q")
+    lo, hi = 0, len(a) // words
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[lo * words : mid * words] == b[lo * words : mid * words]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+# Operand keys the report reads, checked on load so a bad table fails early.
+OPERAND_KEYS = ("opcode", "cycles", "page_cross_incr", "length", "addr_mode")
+
+
+def load_opcodes(path: str = "out/6502.json") -> Dict[int, Tuple[str, dict]]:
+    with open(path, encoding="utf-8") as f:
+        ops = json.load(f)
+    opcodes = {}
+    for op in ops:
+        for operand in op["operands"]:
+            missing = [key for key in OPERAND_KEYS if key not in operand]
+            if missing:
+                raise ValueError(f"{op['name']} operand missing {', '.join(missing)}")
+            opcodes[operand["opcode"]] = (op["name"], operand)
+    return opcodes
+
+
+# Fields sampled before an instruction runs. A difference in any of them at
+# record k was caused by instruction k - 1, while opcode and cycle differences
+# belong to instruction k itself.
+STATE_FIELDS = ("pc", "a", "x", "y", "sp", "p")
+
+
+def _step(trace: Trace, index: int) -> Tuple[Optional[TraceRecord], Optional[int]]:
+    if not 0 <= index < len(trace):
+        return None, None
+    record = trace[index]
+    prev = trace[index - 1].cycles if index else trace.start_cycles
+    return record, record.cycles - prev
+
+
+class Divergence:
+    def __init__(self, expected: Trace, actual: Trace, index: int):
+        self.index = index
+        self.expected = expected[index] if index < len(expected) else None
+        self.actual = actual[index] if index < len(actual) else None
+        self.expected_start = expected.start_cycles
+        self.actual_start = actual.start_cycles
+        # The instruction blamed for the divergence, -1 when the traces
+        # already disagree on the state before the first instruction.
+        if any(name in STATE_FIELDS for name in self.fields):
+            self.culprit = index - 1
+        else:
+            self.culprit = index
+        self.expected_culprit, self.expected_cycles = _step(expected, self.culprit)
+        self.actual_culprit, self.actual_cycles = _step(actual, self.culprit)
+        # Cycles taken by the diverging record itself, which differ from the
+        # culprit's when a state field and the cycle count diverge together.
+        self.expected_record_cycles = _step(expected, index)[1]
+        self.actual_record_cycles = _step(actual, index)[1]
+
+    @property
+    def fields(self):
+        if self.expected is None or self.actual is None:
+            return []
+        fields = [
+            name
+            for name in RECORD_FIELDS
+            if getattr(self.expected, name) != getattr(self.actual, name)
+        ]
+        if self.index == 0 and self.expected_start != self.actual_start:
+            fields.insert(0, "start_cycles")
+        return fields
+
+    @staticmethod
+    def _decode(
+        label: str, record: TraceRecord, opcodes: Dict[int, Tuple[str, dict]]
+    ) -> List[str]:
+        entry = opcodes.get(record.opcode)
+        if entry is None:
+            return [
+                f"  {label}: ${record.pc:04X} ${record.opcode:02X} "
+                "(not in opcode table)"
+            ]
+        name, operand = entry
+        table = str(operand["cycles"])
+        if operand["page_cross_incr"]:
+            table += f" (+{operand['page_cross_incr']} on page cross)"
+        return [
+            f"  {label}: ${record.pc:04X} {name} {operand['addr_mode']} "
+            f"(opcode ${record.opcode:02X}, {operand['length']} bytes)",
+            f"  {label} table cycles: {table}",
+        ]
+
+    def describe(self, opcodes: Dict[int, Tuple[str, dict]]) -> str:
+        lines = [f"traces diverge at record {self.index}"]
+        if self.expected is None:
+            lines.append("  expected trace ended, actual trace continues")
+        elif self.actual is None:
+            lines.append("  actual trace ended, expected trace continues")
+        else:
+            lines.append("  differing fields: " + ", ".join(self.fields))
+        if "start_cycles" in self.fields:
+            lines.append(
+                f"  start cycles: expected {self.expected_start}, "
+                f"actual {self.actual_start}"
+            )
+        lines.append(f"  expected: {self.expected!r}")
+        lines.append(f"  actual:   {self.actual!r}")
+
+        if self.culprit < 0:
+            lines.append("  state differs before the first instruction")
+        else:
+            lines.append(f"  caused by record {self.culprit}")
+            lines += self._describe_step(
+                "",
+                self.expected_culprit,
+                self.actual_culprit,
+                self.expected_cycles,
+                self.actual_cycles,
+                opcodes,
+            )
+        if "cycles" in self.fields and self.culprit != self.index:
+            lines += self._describe_step(
+                f"record {self.index} ",
+                self.expected,
+                self.actual,
+                self.expected_record_cycles,
+                self.actual_record_cycles,
+                opcodes,
+            )
+        return "\n".join(lines)
+
+    @classmethod
+    def _describe_step(
+        cls,
+        prefix: str,
+        expected: Optional[TraceRecord],
+        actual: Optional[TraceRecord],
+        expected_cycles: Optional[int],
+        actual_cycles: Optional[int],
+        opcodes: Dict[int, Tuple[str, dict]],
+    ) -> List[str]:
+        if expected is None or actual is None or expected.opcode == actual.opcode:
+            lines = cls._decode(prefix + "instruction", expected or actual, opcodes)
+        else:
+            lines = cls._decode(prefix + "expected instruction", expected, opcodes)
+            lines += cls._decode(prefix + "actual instruction", actual, opcodes)
+        lines.append(
+            f"  {prefix}cycles taken: expected {expected_cycles}, "
+            f"actual {actual_cycles}"
+        )
+        return lines
+
+
+def compare(
+    expected: Trace, actual: Trace, chunk: int = DEFAULT_CHUNK
+) -> Optional[Divergence]:
+    common = min(len(expected), len(actual))
+    # Identical records after different starting counts still mean the first
+    # instruction took a different number of cycles.
+    if common and expected.start_cycles != actual.start_cycles:
+        return Divergence(expected, actual, 0)
+    for start in range(0, common, chunk):
+        count = min(chunk, common - start)
+        index = first_difference(
+            expected.chunk(start, count), actual.chunk(start, count)
+        )
+        if index >= 0:
+            return Divergence(expected, actual, start + index)
+    if len(expected) != len(actual):
+        return Divergence(expected, actual, common)
+    return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Find the first divergence between two 6502 execution traces."
+    )
+    parser.add_argument("expected", help="reference trace")
+    parser.add_argument("actual", help="trace under test")
+    parser.add_argument(
+        "--table", default="out/6502.json", help="opcode table generated by gen.py"
+    )
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        default=DEFAULT_CHUNK,
+        help="records compared per chunk",
+    )
+    args = parser.parse_args(argv)
+    if args.chunk <= 0:
+        parser.error("--chunk must be positive")
+
+    # Load the table up front so a bad --table fails before a long compare.
+    try:
+        opcodes = load_opcodes(args.table)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"{args.table}: invalid opcode table: {e}", file=sys.stderr)
+        return 2
+
+    try:
+        with Trace(args.expected) as expected, Trace(args.actual) as actual:
+            divergence = compare(expected, actual, args.chunk)
+            if divergence is None:
+                print(f"traces match ({len(expected)} records)")
+                return 0
+            print(divergence.describe(opcodes))
+            return 1
+    except (TraceError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())